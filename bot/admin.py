@@ -20,3 +20,21 @@ class FilmScheduleAdmin(admin.ModelAdmin):
 @admin.register(md.Storage)
 class StorageAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(md.ScheduleSnapshot)
+class ScheduleSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('cinema', 'date', 'etag', 'add_date')
+    exclude = ('content',)
+
+
+@admin.register(md.CinemaHealth)
+class CinemaHealthAdmin(admin.ModelAdmin):
+    list_display = ('cinema', 'state', 'failures', 'error_rate', 'latency', 'opened_at', 'last_error')
+    list_filter = ('state',)
+
+
+@admin.register(md.UsageRollup)
+class UsageRollupAdmin(admin.ModelAdmin):
+    list_display = ('date', 'handler', 'cinema', 'day_offset', 'count', 'cache_hits')
+    list_filter = ('date', 'handler', 'cinema')
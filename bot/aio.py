@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import telebot
+from django.conf import settings
+from django.db import close_old_connections
+from . import analytics
+from .views import (
+    dag_afisha_bot, dag_afisha_logger, AJAX_HEADER, ScheduleSourceUnavailable
+)
+
+
+# sync code (ORM, handlers) runs in this bounded pool and never blocks event loop
+orm_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_ORM_THREADS)
+
+telegram_timeout = aiohttp.ClientTimeout(total=30)
+
+_session = None
+
+
+def get_session():
+    """ shared aiohttp session, it must be created inside running event loop """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+
+    return _session
+
+
+def _call_in_thread(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args, **kwargs):
+    """ run sync function in orm thread pool """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        orm_executor, functools.partial(_call_in_thread, func, *args, **kwargs)
+    )
+
+
+async def fetch_schedule_html(cinema, selected_day, health):
+    """ get schedule from remote site and record health of the source """
+
+    connect_timeout, read_timeout = settings.SCHEDULE_REQUEST_TIMEOUT
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    start = time.monotonic()
+
+    try:
+        async with get_session().post(
+            cinema.schedule_url,
+            data={'day': selected_day.strftime('%Y-%m-%d')},
+            headers=AJAX_HEADER,
+            timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            content = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await run_sync(health.record_failure, time.monotonic() - start, e)
+        dag_afisha_logger.info('schedule source of {} failed: {!r}'.format(cinema, e))
+        raise ScheduleSourceUnavailable(str(e)) from e
+
+    await run_sync(health.record_success, time.monotonic() - start)
+
+    return content.decode('utf-8').strip()
+
+
+async def send_message(chat_id, text, reply_markup=None, parse_mode=None):
+    payload = {'chat_id': str(chat_id), 'text': text}
+    if reply_markup:
+        payload['reply_markup'] = reply_markup.to_json()
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+
+    url = telebot.apihelper.API_URL.format(settings.DAG_AFISHA_TOKEN, 'sendMessage')
+
+    try:
+        async with get_session().post(url, data=payload, timeout=telegram_timeout) as response:
+            response.raise_for_status()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        dag_afisha_logger.info('sending message to {} failed: {!r}'.format(chat_id, e))
+
+
+def handle_message(message):
+    """ find handler of message like telebot does
+    and run it without outbound requests
+    :return handler or None if there is no handler or update was throttled
+    """
+    for message_handler in dag_afisha_bot.message_handlers:
+        if dag_afisha_bot._test_message_handler(message_handler, message):
+            return message_handler['function'](message, defer_io=True)
+
+    return None
+
+
+def call_profiled(profile, func, *args):
+    """ call function with resumed profile of update if it is profiled """
+    if profile is None:
+        return func(*args)
+
+    with profile.resume():
+        return func(*args)
+
+
+async def process_message(message):
+    start = time.monotonic()
+
+    handler = await run_sync(handle_message, message)
+    if handler is None:
+        return None
+
+    profile = getattr(handler, 'profile', None)
+    http_start = time.monotonic()
+    http_time = 0
+
+    if getattr(handler, 'pending_day', None) is not None:
+        try:
+            schedule_html = await fetch_schedule_html(
+                handler.selected_cinema, handler.pending_day, handler.source_health
+            )
+        except ScheduleSourceUnavailable:
+            http_time += time.monotonic() - http_start
+            handler.send_unavailable()
+        else:
+            http_time += time.monotonic() - http_start
+            await run_sync(call_profiled, profile, handler.send_parsed_schedule, schedule_html)
+
+    http_start = time.monotonic()
+    for chat_id, text, kwargs in handler.outbox:
+        await send_message(chat_id, text, **kwargs)
+    http_time += time.monotonic() - http_start
+
+    # latency of the whole update including outbound requests
+    analytics.record(handler, message, time.monotonic() - start)
+
+    if profile is not None:
+        profile.async_http = http_time
+        await run_sync(profile.dump)
@@ -0,0 +1,213 @@
+import json
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+import requests
+from . import models as bot_md
+from .buffers import BatchBuffer
+
+
+Event = namedtuple('Event', 'time handler account_id cinema day_offset latency cache_hit')
+
+# handler name of updates dropped by flood control
+THROTTLED = 'Throttled'
+
+
+class FileSink:
+    """ append events to local file as json lines, useful for tests and debugging """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, events):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for event in events:
+                data = event._asdict()
+                data['time'] = event.time.isoformat()
+                f.write(json.dumps(data, ensure_ascii=False) + '\n')
+
+
+class DbSink:
+    """ aggregate events into daily rollups, raw events aren't stored """
+
+    def __call__(self, events):
+        rollups = {}
+        for event in events:
+            key = (
+                timezone.localdate(event.time),
+                event.handler,
+                event.cinema,
+                bot_md.UsageRollup.NO_DAY if event.day_offset is None else event.day_offset,
+            )
+            rollups.setdefault(key, []).append(event)
+
+        for (date, handler, cinema, day_offset), rollup_events in rollups.items():
+            self.save_rollup(
+                {'date': date, 'handler': handler, 'cinema': cinema, 'day_offset': day_offset},
+                rollup_events
+            )
+
+    def save_rollup(self, key, events):
+        """ add events to rollup, workers flush concurrently,
+        so counters are incremented in db """
+        increments = bot_md.UsageRollup.get_increments(events)
+        updates = {field: F(field) + value for field, value in increments.items() if value}
+
+        if bot_md.UsageRollup.objects.filter(**key).update(**updates):
+            return None
+
+        rollup = bot_md.UsageRollup(**key)
+        rollup.add_events(events)
+        try:
+            with transaction.atomic():
+                rollup.save()
+        except IntegrityError:
+            # other worker has just created the rollup
+            bot_md.UsageRollup.objects.filter(**key).update(**updates)
+
+
+class ChatbaseSink:
+    """ send events to chatbase.com in one request per batch """
+    url = 'https://chatbase.com/api/messages'
+    timeout = 10
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    def __call__(self, events):
+        messages = [
+            {
+                'api_key': self.api_key,
+                'type': 'user',
+                'platform': 'Telegram',
+                'user_id': str(event.account_id),
+                'message': event.cinema or event.handler,
+                'intent': event.handler,
+                'time_stamp': int(event.time.timestamp() * 1000),
+                'not_handled': False,
+            } for event in events
+        ]
+
+        response = requests.post(
+            self.url,
+            json={'messages': messages},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+
+
+def get_sink(name):
+    if name == 'db':
+        return DbSink()
+    if name == 'file':
+        return FileSink(settings.ANALYTICS_FILE)
+    if name == 'chatbase':
+        return ChatbaseSink(settings.CHATBASE_API_KEY)
+
+    raise ValueError('Unknown analytics sink: {}'.format(name))
+
+
+events_buffer = BatchBuffer(
+    get_sink(settings.ANALYTICS_SINK),
+    maxlen=settings.ANALYTICS_BUFFER_SIZE,
+    batch_size=settings.ANALYTICS_BATCH_SIZE,
+    interval=settings.ANALYTICS_FLUSH_INTERVAL,
+)
+
+
+def record_event(handler_name, message, latency, cinema='', day_offset=None, cache_hit=None):
+    """ put event of update to buffer, it is cheap and never touches db """
+    events_buffer.add(Event(
+        time=timezone.now(),
+        handler=handler_name,
+        account_id=message.from_user.id,
+        cinema=cinema,
+        day_offset=day_offset,
+        latency=latency,
+        cache_hit=cache_hit,
+    ))
+
+
+def record(handler, message, latency):
+    """ record event of handled update """
+    record_event(type(handler).__name__, message, latency, **handler.get_event_data())
+
+
+def tracked(handler_class):
+    """ wrap message handler class for recording analytics of every update """
+
+    def handle(message, **kwargs):
+        start = time.monotonic()
+        handler = handler_class(message, **kwargs)
+
+        # async webhook records the update after its outbound requests
+        if not kwargs.get('defer_io'):
+            record(handler, message, time.monotonic() - start)
+
+        return handler
+
+    handle.handler_class = handler_class
+
+    return handle
+
+
+def popular_cinemas(days=7):
+    """ cinema selections, other handlers only report the already selected cinema """
+    since = timezone.localdate() - timezone.timedelta(days=days)
+
+    return bot_md.UsageRollup.objects.filter(
+        date__gte=since,
+        handler='Week',
+    ).values('cinema').annotate(total=Sum('count')).order_by('-total')
+
+
+def popular_days(days=7):
+    """ popularity of week days counted as offset from today """
+    since = timezone.localdate() - timezone.timedelta(days=days)
+
+    return bot_md.UsageRollup.objects.filter(
+        date__gte=since,
+    ).exclude(
+        day_offset=bot_md.UsageRollup.NO_DAY
+    ).values('day_offset').annotate(
+        total=Sum('count'),
+        cache_hits=Sum('cache_hits'),
+    ).order_by('-total')
+
+
+def throttled_count(days=7):
+    since = timezone.localdate() - timezone.timedelta(days=days)
+
+    return bot_md.UsageRollup.objects.filter(
+        date__gte=since,
+        handler=THROTTLED,
+    ).aggregate(total=Sum('count'))['total'] or 0
+
+
+def handlers_latency(days=7):
+    """ :return list of (handler, count, average latency, p95 latency) """
+    since = timezone.localdate() - timezone.timedelta(days=days)
+
+    handlers = {}
+    for rollup in bot_md.UsageRollup.objects.filter(date__gte=since):
+        stats = handlers.setdefault(rollup.handler, {
+            'count': 0,
+            'latency_total': 0,
+            'buckets': [0] * (len(rollup.LATENCY_BUCKETS) + 1),
+        })
+        stats['count'] += rollup.count
+        stats['latency_total'] += rollup.latency_total
+        for i, bucket in enumerate(rollup.get_latency_buckets()):
+            stats['buckets'][i] += bucket
+
+    return [
+        (
+            handler,
+            stats['count'],
+            stats['latency_total'] / stats['count'] if stats['count'] else 0,
+            bot_md.UsageRollup.get_percentile(stats['buckets'], 0.95),
+        ) for handler, stats in sorted(handlers.items())
+    ]
@@ -0,0 +1,79 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from django.db import connection
+
+
+logger = logging.getLogger('dag_afisha_logger')
+
+
+class BatchBuffer:
+    """ In-memory ring buffer flushed in batches by a background thread.
+    When the buffer is full the oldest items are dropped """
+
+    def __init__(self, flush_func, maxlen, batch_size, interval):
+        """
+        :param flush_func: callable getting list of items
+        :param maxlen: max count of items kept in memory
+        :param batch_size: max count of items passed to flush_func at once,
+            also filled batch wakes up flushing thread before interval
+        :param interval: seconds between flushes
+        """
+        self.flush_func = flush_func
+        self.items = deque(maxlen=maxlen)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, item):
+        """ :return the oldest item dropped to make room, or None """
+        dropped_item = None
+
+        with self._lock:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+                dropped_item = self.items.popleft()
+            self.items.append(item)
+            size = len(self.items)
+
+            # thread is started lazily, so every gunicorn worker gets its own one
+            if self._thread is None:
+                self._start()
+
+        if size >= self.batch_size:
+            self._wakeup.set()
+
+        return dropped_item
+
+    def flush(self):
+        """ pass all buffered items to flush_func batch by batch """
+        while True:
+            with self._lock:
+                count = min(self.batch_size, len(self.items))
+                batch = [self.items.popleft() for _ in range(count)]
+
+            if not batch:
+                return None
+
+            try:
+                self.flush_func(batch)
+            except Exception:
+                logger.exception('flushing of {} items failed'.format(len(batch)))
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+            # flush_func may use db, connection of long living thread mustn't stay open
+            connection.close()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from bot import analytics
+from bot.models import UsageRollup
+
+
+class Command(BaseCommand):
+    help = 'Print bot usage statistics from analytics rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='count of last days in report')
+
+    def handle(self, *args, **options):
+        days = options['days']
+
+        self.stdout.write('Cinema selections:')
+        for row in analytics.popular_cinemas(days):
+            self.stdout.write('  {cinema}: {total}'.format(**row))
+
+        self.stdout.write('Popular days (offset from today):')
+        for row in analytics.popular_days(days):
+            self.stdout.write('  +{day_offset}: {total}, from cache {cache_hits}'.format(**row))
+
+        self.stdout.write('Throttled updates: {}'.format(analytics.throttled_count(days)))
+
+        self.stdout.write('Handlers latency:')
+        for handler, count, average, p95 in analytics.handlers_latency(days):
+            p95 = '<= {}s'.format(p95) if p95 is not None else '> {}s'.format(UsageRollup.LATENCY_BUCKETS[-1])
+            self.stdout.write('  {}: {} updates, avg {:.3f}s, p95 {}'.format(handler, count, average, p95))
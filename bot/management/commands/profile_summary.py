@@ -0,0 +1,56 @@
+import io
+import json
+import os
+import pstats
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Print the hottest functions and average wall time breakdown across profiles of updates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.PROFILE_DIR, help='directory with profile dumps')
+        parser.add_argument('--handler', default='', help='summarise only dumps of this handler')
+        parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. cumulative or tottime')
+        parser.add_argument('--limit', type=int, default=30, help='count of printed functions')
+
+    def handle(self, *args, **options):
+        directory = options['dir']
+        if not os.path.isdir(directory):
+            self.stdout.write('There are no profiles in {}'.format(directory))
+            return None
+
+        names = sorted(
+            name[:-len('.prof')] for name in os.listdir(directory)
+            if name.endswith('.prof') and options['handler'] in name
+        )
+        if not names:
+            self.stdout.write('There are no profiles in {}'.format(directory))
+            return None
+
+        breakdown_total = {}
+        queries_count = 0
+        for name in names:
+            try:
+                with open(os.path.join(directory, name + '.json'), encoding='utf-8') as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            queries_count += len(report['queries'])
+            for key, value in report['breakdown'].items():
+                breakdown_total[key] = breakdown_total.get(key, 0) + value
+
+        self.stdout.write('Profiles: {}, queries per update: {:.1f}'.format(
+            len(names), queries_count / len(names)
+        ))
+        self.stdout.write('Average wall time breakdown:')
+        for key, value in sorted(breakdown_total.items()):
+            self.stdout.write('  {}: {:.3f}s'.format(key, value / len(names)))
+
+        # pstats prints table cell by cell, OutputWrapper would end every cell with a new line
+        stream = io.StringIO()
+        stats = pstats.Stats(*(os.path.join(directory, name + '.prof') for name in names), stream=stream)
+        stats.sort_stats(options['sort']).print_stats(options['limit'])
+        self.stdout.write(stream.getvalue(), ending='')
@@ -0,0 +1,30 @@
+# Generated by Django 2.1.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0002_auto_20180925_2317'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Первый день недели')),
+                ('etag', models.CharField(default='', max_length=40, verbose_name='ETag')),
+                ('content', models.BinaryField(default=b'', verbose_name='Сжатый JSON')),
+                ('add_date', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('cinema', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='bot.Cinema', verbose_name='Кинотеатр')),
+            ],
+            options={
+                'verbose_name': 'Снимок графика',
+                'verbose_name_plural': 'Снимки графиков',
+                'ordering': ['-add_date'],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.1.1 on 2026-10-19 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_schedulesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CinemaHealth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('closed', 'Доступен'), ('open', 'Недоступен'), ('half_open', 'Проверяется')], default='closed', max_length=20, verbose_name='Состояние')),
+                ('failures', models.PositiveIntegerField(default=0, verbose_name='Ошибок подряд')),
+                ('requests_count', models.PositiveIntegerField(default=0, verbose_name='Всего запросов')),
+                ('errors_count', models.PositiveIntegerField(default=0, verbose_name='Всего ошибок')),
+                ('latency', models.FloatField(default=0, verbose_name='Среднее время ответа, с')),
+                ('last_error', models.CharField(blank=True, default='', max_length=500, verbose_name='Последняя ошибка')),
+                ('opened_at', models.DateTimeField(blank=True, null=True, verbose_name='Отключен с')),
+                ('add_date', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('cinema', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='health', to='bot.Cinema', verbose_name='Кинотеатр')),
+            ],
+            options={
+                'verbose_name': 'Состояние источника графика',
+                'verbose_name_plural': 'Состояние источников графиков',
+                'ordering': ['-add_date'],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.1.1 on 2026-10-19 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_cinemahealth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('handler', models.CharField(default='', max_length=255, verbose_name='Обработчик')),
+                ('cinema', models.CharField(blank=True, default='', max_length=255, verbose_name='Кинотеатр')),
+                ('day_offset', models.SmallIntegerField(default=-1, verbose_name='Смещение дня')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Запросов')),
+                ('cache_hits', models.PositiveIntegerField(default=0, verbose_name='Из кэша')),
+                ('latency_total', models.FloatField(default=0, verbose_name='Суммарное время, с')),
+                ('latency_50ms', models.PositiveIntegerField(default=0, verbose_name='До 50 мс')),
+                ('latency_100ms', models.PositiveIntegerField(default=0, verbose_name='До 100 мс')),
+                ('latency_250ms', models.PositiveIntegerField(default=0, verbose_name='До 250 мс')),
+                ('latency_500ms', models.PositiveIntegerField(default=0, verbose_name='До 500 мс')),
+                ('latency_1s', models.PositiveIntegerField(default=0, verbose_name='До 1 с')),
+                ('latency_2s', models.PositiveIntegerField(default=0, verbose_name='До 2 с')),
+                ('latency_5s', models.PositiveIntegerField(default=0, verbose_name='До 5 с')),
+                ('latency_10s', models.PositiveIntegerField(default=0, verbose_name='До 10 с')),
+                ('latency_slower', models.PositiveIntegerField(default=0, verbose_name='Дольше 10 с')),
+            ],
+            options={
+                'verbose_name': 'Статистика',
+                'verbose_name_plural': 'Статистика',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='usagerollup',
+            unique_together={('date', 'handler', 'cinema', 'day_offset')},
+        ),
+    ]
@@ -1,5 +1,11 @@
+import gzip
+import hashlib
+import json
+from bisect import bisect_left
+from itertools import groupby
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
 
@@ -60,6 +66,105 @@ class Cinema(models.Model):
         verbose_name_plural = 'Кинотеатры'
 
 
+class CinemaHealth(models.Model):
+    """ Health of cinema schedule source with circuit breaker state """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATES = (
+        (CLOSED, 'Доступен'),
+        (OPEN, 'Недоступен'),
+        (HALF_OPEN, 'Проверяется'),
+    )
+
+    cinema = models.OneToOneField(
+        Cinema, verbose_name='Кинотеатр', related_name='health', on_delete=models.CASCADE
+    )
+    state = models.CharField('Состояние', max_length=20, choices=STATES, default=CLOSED)
+    failures = models.PositiveIntegerField('Ошибок подряд', default=0)
+    requests_count = models.PositiveIntegerField('Всего запросов', default=0)
+    errors_count = models.PositiveIntegerField('Всего ошибок', default=0)
+    latency = models.FloatField('Среднее время ответа, с', default=0)
+    last_error = models.CharField('Последняя ошибка', max_length=500, default='', blank=True)
+    opened_at = models.DateTimeField('Отключен с', null=True, blank=True)
+    add_date = models.DateTimeField('Дата обновления', auto_now=True)
+
+    # weight of the last request in average latency
+    latency_weight = 0.2
+
+    def __str__(self):
+        return str(self.cinema)
+
+    class Meta:
+        ordering = ['-add_date']
+        verbose_name = 'Состояние источника графика'
+        verbose_name_plural = 'Состояние источников графиков'
+
+    @classmethod
+    def get_for(cls, cinema):
+        health, created = cls.objects.get_or_create(cinema=cinema)
+        return health
+
+    @property
+    def error_rate(self):
+        if not self.requests_count:
+            return 0
+        return self.errors_count / self.requests_count
+
+    def is_available(self):
+        return self.state == self.CLOSED
+
+    def claim_probe(self):
+        """ Move breaker to half-open state if cooldown has passed.
+        Update is conditional, so only one worker gets the probe
+        :return True if this worker has to probe the source
+        """
+        now = timezone.now()
+        cooldown_start = now - timezone.timedelta(seconds=settings.SCHEDULE_BREAKER_COOLDOWN)
+
+        claimed = type(self).objects.filter(
+            pk=self.pk,
+            state__in=(self.OPEN, self.HALF_OPEN),
+            opened_at__lte=cooldown_start,
+        ).update(state=self.HALF_OPEN, opened_at=now)
+
+        return bool(claimed)
+
+    def get_latency_expression(self, latency):
+        """ moving average of latency, the first request sets it as is """
+        return models.Case(
+            models.When(requests_count=0, then=models.Value(latency)),
+            default=models.F('latency') * (1 - self.latency_weight) + latency * self.latency_weight,
+            output_field=models.FloatField(),
+        )
+
+    def record_success(self, latency):
+        type(self).objects.filter(pk=self.pk).update(
+            state=self.CLOSED,
+            failures=0,
+            requests_count=models.F('requests_count') + 1,
+            latency=self.get_latency_expression(latency),
+            opened_at=None,
+        )
+
+    def record_failure(self, latency, error):
+        type(self).objects.filter(pk=self.pk).update(
+            failures=models.F('failures') + 1,
+            requests_count=models.F('requests_count') + 1,
+            errors_count=models.F('errors_count') + 1,
+            latency=self.get_latency_expression(latency),
+            last_error=str(error)[:500],
+        )
+        self.refresh_from_db()
+
+        # failed probe opens breaker again without waiting for threshold
+        if self.state == self.HALF_OPEN or self.failures >= settings.SCHEDULE_BREAKER_THRESHOLD:
+            type(self).objects.filter(pk=self.pk).exclude(state=self.OPEN).update(
+                state=self.OPEN,
+                opened_at=timezone.now(),
+            )
+
+
 class FilmSchedule(models.Model):
     cinema = models.ForeignKey(Cinema, verbose_name='Кинотеатр', null=True, on_delete=models.CASCADE)
     name = models.CharField('Название', max_length=255, default='')
@@ -90,3 +195,172 @@ class Storage(models.Model):
         ordering = ['-add_date']
         verbose_name = 'Данные'
         verbose_name_plural = 'Хранилище'
+
+
+class ScheduleSnapshot(models.Model):
+    """ Precomputed compressed weekly schedule of cinema for read-only api """
+    cinema = models.OneToOneField(
+        Cinema, verbose_name='Кинотеатр', related_name='snapshot', on_delete=models.CASCADE
+    )
+    date = models.DateField('Первый день недели')
+    etag = models.CharField('ETag', max_length=40, default='')
+    content = models.BinaryField('Сжатый JSON', default=b'')
+    add_date = models.DateTimeField('Дата обновления', auto_now=True)
+
+    days_count = 7
+
+    def __str__(self):
+        return str(self.cinema)
+
+    class Meta:
+        ordering = ['-add_date']
+        verbose_name = 'Снимок графика'
+        verbose_name_plural = 'Снимки графиков'
+
+    @classmethod
+    def build(cls, cinema):
+        """ render weekly schedule of cinema to gzipped json and save it """
+        first_day = timezone.localdate()
+        last_day = first_day + timezone.timedelta(days=cls.days_count - 1)
+
+        schedule = FilmSchedule.objects.filter(
+            cinema=cinema,
+            date__range=(first_day, last_day),
+        ).order_by('date', 'name', 'time')
+
+        days = []
+        for date, day_films in groupby(schedule, key=lambda x: x.date):
+            films = [
+                {
+                    'name': name,
+                    'sessions': [
+                        {'time': film.time, 'price': film.price, 'format': film.film_format}
+                        for film in sessions
+                    ],
+                } for name, sessions in groupby(day_films, key=lambda x: x.name)
+            ]
+            days.append({'date': date.isoformat(), 'films': films})
+
+        data = json.dumps(
+            {'cinema': {'id': cinema.pk, 'title': cinema.title}, 'days': days},
+            ensure_ascii=False,
+            sort_keys=True,
+        ).encode('utf-8')
+
+        snapshot, created = cls.objects.update_or_create(
+            cinema=cinema,
+            defaults={
+                'date': first_day,
+                'etag': hashlib.sha1(data).hexdigest(),
+                'content': gzip.compress(data),
+            }
+        )
+        return snapshot
+
+    @classmethod
+    def get_actual(cls, cinema_id):
+        """ return today's snapshot of cinema, rebuild it if it is outdated or missing
+        :raise Cinema.DoesNotExist
+        """
+        snapshot = cls.objects.filter(cinema_id=cinema_id, date=timezone.localdate()).first()
+        if snapshot is not None:
+            return snapshot
+
+        # update_or_create of build handles concurrent rebuilds itself
+        return cls.build(Cinema.objects.get(pk=cinema_id))
+
+    def get_etag(self, gzipped=False):
+        """ strong etag, compressed and plain representations must differ """
+        if gzipped:
+            return '"{}-gzip"'.format(self.etag)
+        return '"{}"'.format(self.etag)
+
+    def get_content(self, gzipped=False):
+        content = bytes(self.content)
+        if gzipped:
+            return content
+        return gzip.decompress(content)
+
+    @staticmethod
+    def invalidate(sender, instance, *args, **kwargs):
+        """ drop snapshot when schedule was changed,
+        it will be rebuilt on the next api request """
+        ScheduleSnapshot.objects.filter(cinema_id=instance.cinema_id).delete()
+
+
+post_save.connect(ScheduleSnapshot.invalidate, sender=FilmSchedule)
+post_delete.connect(ScheduleSnapshot.invalidate, sender=FilmSchedule)
+
+
+class UsageRollup(models.Model):
+    """ Daily aggregate of handled updates, filled by analytics in batches """
+    # upper bounds of latency histogram buckets in seconds, last bucket is unbounded
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+    LATENCY_BUCKET_FIELDS = (
+        'latency_50ms', 'latency_100ms', 'latency_250ms', 'latency_500ms',
+        'latency_1s', 'latency_2s', 'latency_5s', 'latency_10s', 'latency_slower',
+    )
+    # day_offset of updates not related to a day, it isn't null for unique key of rollup
+    NO_DAY = -1
+
+    date = models.DateField('Дата')
+    handler = models.CharField('Обработчик', max_length=255, default='')
+    cinema = models.CharField('Кинотеатр', max_length=255, default='', blank=True)
+    day_offset = models.SmallIntegerField('Смещение дня', default=NO_DAY)
+    count = models.PositiveIntegerField('Запросов', default=0)
+    cache_hits = models.PositiveIntegerField('Из кэша', default=0)
+    latency_total = models.FloatField('Суммарное время, с', default=0)
+    latency_50ms = models.PositiveIntegerField('До 50 мс', default=0)
+    latency_100ms = models.PositiveIntegerField('До 100 мс', default=0)
+    latency_250ms = models.PositiveIntegerField('До 250 мс', default=0)
+    latency_500ms = models.PositiveIntegerField('До 500 мс', default=0)
+    latency_1s = models.PositiveIntegerField('До 1 с', default=0)
+    latency_2s = models.PositiveIntegerField('До 2 с', default=0)
+    latency_5s = models.PositiveIntegerField('До 5 с', default=0)
+    latency_10s = models.PositiveIntegerField('До 10 с', default=0)
+    latency_slower = models.PositiveIntegerField('Дольше 10 с', default=0)
+
+    def __str__(self):
+        return '{} {}'.format(self.date, self.handler)
+
+    class Meta:
+        ordering = ['-date']
+        unique_together = ['date', 'handler', 'cinema', 'day_offset']
+        verbose_name = 'Статистика'
+        verbose_name_plural = 'Статистика'
+
+    def get_latency_buckets(self):
+        return [getattr(self, field) for field in self.LATENCY_BUCKET_FIELDS]
+
+    @classmethod
+    def get_increments(cls, events):
+        """ values added to counters of rollup by events """
+        increments = dict.fromkeys(('count', 'cache_hits', 'latency_total') + cls.LATENCY_BUCKET_FIELDS, 0)
+
+        for event in events:
+            increments['count'] += 1
+            increments['cache_hits'] += bool(event.cache_hit)
+            increments['latency_total'] += event.latency
+            increments[cls.LATENCY_BUCKET_FIELDS[bisect_left(cls.LATENCY_BUCKETS, event.latency)]] += 1
+
+        return increments
+
+    def add_events(self, events):
+        for field, value in self.get_increments(events).items():
+            setattr(self, field, getattr(self, field) + value)
+
+    @classmethod
+    def get_percentile(cls, buckets, percentile):
+        """ upper bound of the bucket containing percentile,
+        None if it is in the unbounded bucket or there is no data """
+        total = sum(buckets)
+        if not total:
+            return None
+
+        passed = 0
+        for bound, bucket in zip(cls.LATENCY_BUCKETS, buckets):
+            passed += bucket
+            if passed >= total * percentile:
+                return bound
+
+        return None
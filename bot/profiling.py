@@ -0,0 +1,154 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger('dag_afisha_logger')
+
+# functions whose cumulative time is shown in wall time breakdown
+BREAKDOWN_FUNCTIONS = {
+    'http': ('requests/sessions.py', 'request'),
+    'html_parse': ('bs4/__init__.py', '__init__'),
+}
+
+
+def should_profile(handler_name, chat_id):
+    if handler_name in settings.PROFILE_UPDATES_HANDLERS:
+        return True
+    if chat_id in settings.PROFILE_UPDATES_CHATS:
+        return True
+
+    return random.random() < settings.PROFILE_UPDATES_RATE
+
+
+def get_breakdown(stats, wall, queries, async_http=0):
+    """ split wall time of update to sql, outbound http, html parsing and the rest
+    :param async_http: time of requests made by async webhook outside of profiler
+    """
+    breakdown = {'sql': sum(query['time'] for query in queries)}
+
+    for name, (file_suffix, func_name) in BREAKDOWN_FUNCTIONS.items():
+        breakdown[name] = sum(
+            cumulative_time
+            for (filename, line, func), (cc, nc, tt, cumulative_time, callers) in stats.stats.items()
+            if func == func_name and filename.replace('\\', '/').endswith(file_suffix)
+        )
+
+    breakdown['http'] += async_http
+    breakdown['other'] = max(0, wall - sum(breakdown.values()))
+    breakdown['wall'] = wall
+
+    return breakdown
+
+
+def rotate_dumps(directory, max_dumps):
+    """ delete the oldest dumps, names start with timestamp """
+    dumps = sorted(name[:-len('.prof')] for name in os.listdir(directory) if name.endswith('.prof'))
+
+    for name in dumps[:-max_dumps]:
+        for ext in ('.prof', '.json'):
+            path = os.path.join(directory, name + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class UpdateProfile:
+    """ Profile of one update, it can be resumed when handling
+    of the update continues later, e.g. after async outbound requests """
+
+    def __init__(self, handler_name, message):
+        self.handler_name = handler_name
+        self.message = message
+        self.profiler = cProfile.Profile()
+        self.queries = []
+        self.async_http = 0
+        self.start = time.monotonic()
+
+    def capture_query(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'time': time.monotonic() - start})
+
+    @contextmanager
+    def resume(self):
+        with connection.execute_wrapper(self.capture_query):
+            self.profiler.enable()
+            try:
+                yield
+            finally:
+                self.profiler.disable()
+
+    def dump(self):
+        try:
+            self._dump()
+        except Exception:
+            logger.exception('dumping profile of update failed')
+
+    def _dump(self):
+        directory = settings.PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+
+        name = '{}-{:03d}-{}-{}-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'),
+            int(time.time() * 1000) % 1000,
+            os.getpid(),
+            self.handler_name,
+            self.message.chat.id,
+        )
+        path = os.path.join(directory, name)
+
+        self.profiler.dump_stats(path + '.prof')
+
+        breakdown = get_breakdown(
+            pstats.Stats(self.profiler), time.monotonic() - self.start, self.queries, self.async_http
+        )
+        report = {
+            'handler': self.handler_name,
+            'chat_id': self.message.chat.id,
+            'text': self.message.text,
+            'breakdown': breakdown,
+            'queries': self.queries,
+        }
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        rotate_dumps(directory, settings.PROFILE_MAX_DUMPS)
+
+
+def profiled(handle):
+    """ wrap message handler for profiling of sampled or selected updates """
+    handler_name = handle.handler_class.__name__
+
+    def profiled_handle(message, **kwargs):
+        if not should_profile(handler_name, message.chat.id):
+            return handle(message, **kwargs)
+
+        profile = UpdateProfile(handler_name, message)
+        deferred = False
+
+        try:
+            with profile.resume():
+                handler = handle(message, **kwargs)
+
+            # async webhook continues handling and dumps profile itself
+            deferred = kwargs.get('defer_io') and handler is not None
+            if deferred:
+                handler.profile = profile
+
+            return handler
+        finally:
+            if not deferred:
+                profile.dump()
+
+    profiled_handle.handler_class = handle.handler_class
+
+    return profiled_handle
@@ -1,3 +1,528 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils.module_loading import import_string
+from django.utils import timezone
+from . import models as bot_md
+from . import analytics
+from .analytics import Event, DbSink, FileSink
+from .buffers import BatchBuffer
+from . import profiling, throttling
+from .users import KnownUsers
+from . import aio, views
 
-# Create your tests here.
+
+def make_event(handler='FilmSchedule', latency=0.2, cache_hit=True, day_offset=1):
+    return Event(
+        time=timezone.now(),
+        handler=handler,
+        account_id=1,
+        cinema='Москва',
+        day_offset=day_offset,
+        latency=latency,
+        cache_hit=cache_hit,
+    )
+
+
+@override_settings(SCHEDULE_BREAKER_THRESHOLD=2, SCHEDULE_BREAKER_COOLDOWN=60)
+class CinemaHealthTest(TestCase):
+
+    def setUp(self):
+        cinema = bot_md.Cinema.objects.create(title='Москва')
+        self.health = bot_md.CinemaHealth.get_for(cinema)
+
+    def refresh(self):
+        self.health.refresh_from_db()
+        return self.health
+
+    def test_breaker_cycle(self):
+        self.health.record_failure(1, 'timeout')
+        self.assertEqual(self.refresh().state, bot_md.CinemaHealth.CLOSED)
+
+        self.health.record_failure(1, 'timeout')
+        self.assertEqual(self.refresh().state, bot_md.CinemaHealth.OPEN)
+        self.assertFalse(self.health.is_available())
+
+        # cooldown hasn't passed yet
+        self.assertFalse(self.health.claim_probe())
+
+        bot_md.CinemaHealth.objects.update(opened_at=timezone.now() - timezone.timedelta(seconds=61))
+        self.assertTrue(self.health.claim_probe())
+        self.assertEqual(self.refresh().state, bot_md.CinemaHealth.HALF_OPEN)
+
+        # only one worker gets the probe
+        self.assertFalse(self.health.claim_probe())
+
+        self.health.record_success(1)
+        self.assertEqual(self.refresh().state, bot_md.CinemaHealth.CLOSED)
+        self.assertEqual(self.health.failures, 0)
+        self.assertEqual(self.health.error_rate, 2 / 3)
+
+    def test_failed_probe_opens_breaker(self):
+        bot_md.CinemaHealth.objects.update(
+            state=bot_md.CinemaHealth.HALF_OPEN,
+            opened_at=timezone.now() - timezone.timedelta(seconds=61),
+        )
+
+        self.refresh().record_failure(1, 'timeout')
+
+        self.assertEqual(self.refresh().state, bot_md.CinemaHealth.OPEN)
+        self.assertFalse(self.health.claim_probe())
+
+    def test_latency(self):
+        self.health.record_success(2)
+        self.assertEqual(self.refresh().latency, 2)
+
+        self.health.record_failure(4, 'timeout')
+        self.assertAlmostEqual(self.refresh().latency, 2 * 0.8 + 4 * 0.2)
+
+
+# buffers are flushed manually in tests, without background thread
+@mock.patch.object(BatchBuffer, '_start')
+class BatchBufferTest(SimpleTestCase):
+
+    def test_batches(self, start):
+        batches = []
+        buffer = BatchBuffer(batches.append, maxlen=10, batch_size=3, interval=60)
+
+        for i in range(7):
+            buffer.add(i)
+        buffer.flush()
+
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(len(buffer.items), 0)
+
+    def test_overflow(self, start):
+        batches = []
+        buffer = BatchBuffer(batches.append, maxlen=3, batch_size=10, interval=60)
+
+        for i in range(5):
+            buffer.add(i)
+        buffer.flush()
+
+        self.assertEqual(batches, [[2, 3, 4]])
+        self.assertEqual(buffer.dropped, 2)
+
+    def test_add_returns_dropped(self, start):
+        buffer = BatchBuffer(mock.Mock(), maxlen=2, batch_size=10, interval=60)
+
+        self.assertIsNone(buffer.add(0))
+        self.assertIsNone(buffer.add(1))
+        self.assertEqual(buffer.add(2), 0)
+
+    def test_failed_flush(self, start):
+        buffer = BatchBuffer(mock.Mock(side_effect=ValueError), maxlen=10, batch_size=2, interval=60)
+
+        for i in range(3):
+            buffer.add(i)
+
+        with self.assertLogs('dag_afisha_logger', 'ERROR'):
+            buffer.flush()
+
+        self.assertEqual(buffer.flush_func.call_count, 2)
+
+
+class UsageRollupTest(TestCase):
+
+    def test_add_events(self):
+        rollup = bot_md.UsageRollup()
+        rollup.add_events([
+            make_event(latency=0.01),
+            make_event(latency=0.3, cache_hit=False),
+            make_event(latency=20),
+        ])
+
+        self.assertEqual(rollup.count, 3)
+        self.assertEqual(rollup.cache_hits, 2)
+        self.assertAlmostEqual(rollup.latency_total, 20.31)
+        self.assertEqual(rollup.get_latency_buckets(), [1, 0, 0, 1, 0, 0, 0, 0, 1])
+
+    def test_get_percentile(self):
+        get_percentile = bot_md.UsageRollup.get_percentile
+
+        self.assertIsNone(get_percentile([0] * 9, 0.95))
+        self.assertEqual(get_percentile([95, 5, 0, 0, 0, 0, 0, 0, 0], 0.95), 0.05)
+        self.assertEqual(get_percentile([90, 5, 5, 0, 0, 0, 0, 0, 0], 0.95), 0.1)
+        # percentile in unbounded bucket
+        self.assertIsNone(get_percentile([90, 0, 0, 0, 0, 0, 0, 0, 10], 0.95))
+
+    def test_db_sink(self):
+        sink = DbSink()
+
+        sink([make_event(latency=0.01), make_event(handler='Week', day_offset=None)])
+        sink([make_event(latency=3, cache_hit=False)])
+
+        rollup = bot_md.UsageRollup.objects.get(handler='FilmSchedule')
+        self.assertEqual(rollup.count, 2)
+        self.assertEqual(rollup.cache_hits, 1)
+        self.assertEqual(rollup.get_latency_buckets(), [1, 0, 0, 0, 0, 0, 1, 0, 0])
+
+        rollup = bot_md.UsageRollup.objects.get(handler='Week')
+        self.assertEqual(rollup.day_offset, bot_md.UsageRollup.NO_DAY)
+
+    def test_db_sink_concurrent_create(self):
+        """ rollup created by other worker between update and insert """
+        sink = DbSink()
+        sink([make_event()])
+
+        queryset = bot_md.UsageRollup.objects.filter(handler='FilmSchedule')
+
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=[0, 1]) as update_mock:
+            sink([make_event()])
+
+        self.assertEqual(update_mock.call_count, 2)
+        self.assertEqual(queryset.count(), 1)
+
+    def test_popular_cinemas(self):
+        DbSink()([
+            make_event(handler='Week', day_offset=None),
+            make_event(handler='Cinemas', day_offset=None),
+            make_event(),
+            make_event(day_offset=2),
+        ])
+
+        self.assertEqual(list(analytics.popular_cinemas()), [{'cinema': 'Москва', 'total': 1}])
+
+
+class FileSinkTest(SimpleTestCase):
+
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'analytics.log')
+            sink = FileSink(path)
+
+            sink([make_event(), make_event(handler='Week', day_offset=None)])
+            sink([make_event(cache_hit=None)])
+
+            with open(path, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f]
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0]['cinema'], 'Москва')
+        self.assertEqual(lines[1]['handler'], 'Week')
+        self.assertIsNone(lines[1]['day_offset'])
+        self.assertIsNone(lines[2]['cache_hit'])
+
+
+@mock.patch('bot.throttling.time.monotonic')
+class LocalTokenBucketsTest(SimpleTestCase):
+
+    def test_refill(self, monotonic):
+        monotonic.return_value = 100
+        buckets = throttling.LocalTokenBuckets(rate=1, burst=2, maxsize=10)
+
+        self.assertTrue(buckets.consume(1))
+        self.assertTrue(buckets.consume(1))
+        self.assertFalse(buckets.consume(1))
+        # other users have their own buckets
+        self.assertTrue(buckets.consume(2))
+
+        monotonic.return_value = 101
+        self.assertTrue(buckets.consume(1))
+        self.assertFalse(buckets.consume(1))
+
+        # bucket isn't filled over burst
+        monotonic.return_value = 200
+        self.assertTrue(buckets.consume(1))
+        self.assertTrue(buckets.consume(1))
+        self.assertFalse(buckets.consume(1))
+
+    def test_eviction(self, monotonic):
+        monotonic.return_value = 100
+        buckets = throttling.LocalTokenBuckets(rate=1, burst=1, maxsize=2)
+
+        buckets.consume(1)
+        buckets.consume(2)
+        # user 1 is the least recently active one
+        buckets.consume(2)
+        buckets.consume(3)
+
+        self.assertEqual(list(buckets.buckets), [2, 3])
+        # evicted user starts with full bucket
+        self.assertTrue(buckets.consume(1))
+        self.assertEqual(list(buckets.buckets), [3, 1])
+
+
+class ThrottledTest(SimpleTestCase):
+
+    @override_settings(FLOOD_CONTROL_REDIS_URL='redis://localhost:6379/0')
+    def test_missing_redis_package(self):
+        with mock.patch.dict('sys.modules', {'redis': None}):
+            with self.assertLogs('dag_afisha_logger', 'ERROR'):
+                buckets = throttling.get_buckets()
+
+        self.assertIsInstance(buckets, throttling.LocalTokenBuckets)
+
+    @mock.patch('bot.analytics.record_event')
+    def test_drop(self, record_event):
+        handle = mock.Mock(handler_class=object)
+        message = mock.Mock()
+        message.from_user.id = 1
+
+        with mock.patch.object(throttling, 'buckets', throttling.LocalTokenBuckets(rate=1, burst=1, maxsize=10)):
+            throttled_handle = throttling.throttled(handle)
+            throttled_handle(message)
+            self.assertIsNone(throttled_handle(message))
+
+        handle.assert_called_once_with(message)
+        record_event.assert_called_once_with('Throttled', message, 0)
+
+
+def make_message(account_id=1, chat_id=10):
+    message = mock.Mock()
+    message.from_user.id = account_id
+    message.from_user.is_bot = False
+    message.from_user.first_name = 'Имя'
+    message.from_user.last_name = 'Фамилия'
+    message.from_user.username = 'user{}'.format(account_id)
+    message.chat.id = chat_id
+
+    return message
+
+
+@mock.patch.object(BatchBuffer, '_start')
+class KnownUsersTest(TestCase):
+
+    def test_remember(self, start):
+        bot_md.TelegramUser.objects.create(account_id=1, chat_id=10, username='user1')
+        known_users = KnownUsers()
+
+        with self.assertNumQueries(1):
+            self.assertFalse(known_users.remember(make_message(1, 10)))
+            self.assertFalse(known_users.remember(make_message(1, 10)))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(known_users.remember(make_message(2, 20)))
+            self.assertTrue(known_users.remember(make_message(1, 11)))
+            self.assertFalse(known_users.remember(make_message(2, 20)))
+
+        known_users.pending.flush()
+
+        self.assertEqual(
+            dict(bot_md.TelegramUser.objects.values_list('account_id', 'chat_id')),
+            {1: 11, 2: 20}
+        )
+        self.assertEqual(bot_md.TelegramUser.objects.get(account_id=2).username, 'user2')
+
+    def test_failed_save(self, start):
+        known_users = KnownUsers()
+        known_users.remember(make_message(1, 10))
+
+        with mock.patch('bot.users.save_users', side_effect=ValueError):
+            with self.assertLogs('dag_afisha_logger', 'ERROR'):
+                known_users.pending.flush()
+
+        self.assertFalse(bot_md.TelegramUser.objects.exists())
+
+        # user is queued again
+        self.assertTrue(known_users.remember(make_message(1, 10)))
+        known_users.pending.flush()
+        self.assertTrue(bot_md.TelegramUser.objects.filter(account_id=1, chat_id=10).exists())
+
+    @override_settings(KNOWN_USERS_BUFFER_SIZE=2)
+    def test_overflow(self, start):
+        known_users = KnownUsers()
+        for account_id in range(1, 5):
+            known_users.remember(make_message(account_id, account_id * 10))
+
+        # the oldest users were dropped from full buffer and are queued again
+        self.assertTrue(known_users.remember(make_message(1, 10)))
+        self.assertFalse(known_users.remember(make_message(4, 40)))
+
+        known_users.pending.flush()
+        self.assertEqual(
+            dict(bot_md.TelegramUser.objects.values_list('account_id', 'chat_id')),
+            {1: 10, 4: 40}
+        )
+
+
+class ProfilingTest(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    @override_settings(PROFILE_UPDATES_HANDLERS=['Info'], PROFILE_UPDATES_CHATS=[10], PROFILE_UPDATES_RATE=0)
+    def test_should_profile(self):
+        self.assertTrue(profiling.should_profile('Info', 20))
+        self.assertTrue(profiling.should_profile('Week', 10))
+        self.assertFalse(profiling.should_profile('Week', 20))
+
+        with mock.patch('bot.profiling.random.random', return_value=0.05):
+            with self.settings(PROFILE_UPDATES_RATE=0.1):
+                self.assertTrue(profiling.should_profile('Week', 20))
+            with self.settings(PROFILE_UPDATES_RATE=0.01):
+                self.assertFalse(profiling.should_profile('Week', 20))
+
+    def test_get_breakdown(self):
+        stats = SimpleNamespace(stats={
+            ('/env/requests/sessions.py', 450, 'request'): (1, 1, 0.01, 0.5, {}),
+            ('/env/bs4/__init__.py', 80, '__init__'): (2, 2, 0.01, 0.2, {}),
+            ('/env/other.py', 1, 'request'): (1, 1, 0.01, 9, {}),
+        })
+        queries = [{'sql': 'SELECT 1', 'time': 0.1}, {'sql': 'SELECT 2', 'time': 0.2}]
+
+        breakdown = profiling.get_breakdown(stats, 1.5, queries, async_http=0.3)
+
+        self.assertEqual(set(breakdown), {'sql', 'http', 'html_parse', 'other', 'wall'})
+        self.assertAlmostEqual(breakdown['sql'], 0.3)
+        self.assertAlmostEqual(breakdown['http'], 0.8)
+        self.assertAlmostEqual(breakdown['html_parse'], 0.2)
+        self.assertAlmostEqual(breakdown['other'], 0.2)
+        self.assertEqual(breakdown['wall'], 1.5)
+
+    def test_rotate_dumps(self):
+        for i in range(4):
+            for ext in ('.prof', '.json'):
+                open(os.path.join(self.directory, '20261019-12000{}-000-1-Info-10{}'.format(i, ext)), 'w').close()
+
+        profiling.rotate_dumps(self.directory, 2)
+
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            '20261019-120002-000-1-Info-10.json',
+            '20261019-120002-000-1-Info-10.prof',
+            '20261019-120003-000-1-Info-10.json',
+            '20261019-120003-000-1-Info-10.prof',
+        ])
+
+    def profile_update(self):
+        handle = mock.Mock(handler_class=views.Info, side_effect=lambda message: sorted(range(1000)))
+        message = make_message(1, 10)
+        message.text = 'Инфо'
+
+        with self.settings(PROFILE_DIR=self.directory, PROFILE_UPDATES_HANDLERS=['Info']):
+            profiling.profiled(handle)(message)
+
+        handle.assert_called_once_with(message)
+
+    def test_profiled(self):
+        self.profile_update()
+
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].endswith('-Info-10.json'))
+        self.assertEqual(names[1], names[0][:-len('.json')] + '.prof')
+
+        with open(os.path.join(self.directory, names[0]), encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(report['handler'], 'Info')
+        self.assertEqual(report['chat_id'], 10)
+        self.assertEqual(report['text'], 'Инфо')
+        self.assertGreater(report['breakdown']['wall'], 0)
+
+    def test_profile_summary(self):
+        self.profile_update()
+        self.profile_update()
+        out = io.StringIO()
+
+        call_command('profile_summary', dir=self.directory, handler='Info', stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Profiles: 2, queries per update: 0.0')
+        self.assertIn('Average wall time breakdown:', lines)
+        # every row of functions table is printed on its own line
+        self.assertTrue(any('ncalls' in line and 'percall' in line and 'filename:lineno' in line for line in lines))
+        self.assertTrue(any(line.split()[0] == '2' and 'builtins.sorted' in line for line in lines if line.strip()))
+
+    def test_profile_summary_without_dumps(self):
+        out = io.StringIO()
+
+        call_command('profile_summary', dir=self.directory, stdout=out)
+
+        self.assertEqual(out.getvalue(), 'There are no profiles in {}\n'.format(self.directory))
+
+
+@mock.patch('bot.analytics.record')
+class DeferredFilmScheduleTest(TestCase):
+    schedule_html = (
+        '<table><tr><td><a>Фильм</a></td><td>'
+        '<span class="times"><span>12:00</span><b>250 руб.</b></span>'
+        '</td></tr></table>'
+    )
+
+    def setUp(self):
+        self.cinema = bot_md.Cinema.objects.create(title='Москва', schedule_url='http://cinema.test/')
+        bot_md.Storage.objects.create(account_id=1, key='selected_cinema', value='Москва')
+        self.message = make_message(1, 10)
+        self.message.text = views.Week.get_week_days()[1]
+
+    def test_cache_miss(self, record):
+        handler = views.FilmSchedule(self.message, defer_io=True)
+
+        self.assertIsNotNone(handler.pending_day)
+        self.assertEqual(handler.source_health.cinema, self.cinema)
+        self.assertEqual(handler.outbox, [])
+
+        bot_md.ScheduleSnapshot.build(self.cinema)
+        handler.send_parsed_schedule(self.schedule_html)
+
+        self.assertEqual(bot_md.FilmSchedule.objects.get().price, 250)
+        # api snapshot is rebuilt lazily by the api, not by the scrape
+        self.assertFalse(bot_md.ScheduleSnapshot.objects.exists())
+        chat_id, text, kwargs = handler.outbox[0]
+        self.assertEqual(chat_id, 10)
+        self.assertIn('Фильм', text)
+        self.assertEqual(kwargs, {'parse_mode': 'HTML'})
+
+    def test_unavailable_source(self, record):
+        health = bot_md.CinemaHealth.get_for(self.cinema)
+        bot_md.CinemaHealth.objects.filter(pk=health.pk).update(
+            state=bot_md.CinemaHealth.OPEN, opened_at=timezone.now()
+        )
+
+        handler = views.FilmSchedule(self.message, defer_io=True)
+
+        self.assertIsNone(handler.pending_day)
+        self.assertEqual(len(handler.outbox), 1)
+
+
+class ProcessMessageTest(SimpleTestCase):
+
+    @staticmethod
+    async def slow(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return '<table></table>'
+
+    @mock.patch('bot.analytics.record')
+    def test_latency_includes_outbound_io(self, record):
+        handler = SimpleNamespace(
+            pending_day=timezone.now(),
+            selected_cinema=None,
+            source_health=None,
+            outbox=[(10, 'text', {})],
+            send_parsed_schedule=mock.Mock(),
+            profile=mock.MagicMock(async_http=0),
+        )
+
+        with mock.patch.object(aio, 'handle_message', return_value=handler), \
+                mock.patch.object(aio, 'fetch_schedule_html', self.slow), \
+                mock.patch.object(aio, 'send_message', self.slow):
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(aio.process_message(make_message()))
+            finally:
+                loop.close()
+
+        handler.send_parsed_schedule.assert_called_once_with('<table></table>')
+        handler.profile.resume.assert_called_once_with()
+        handler.profile.dump.assert_called_once_with()
+        self.assertGreaterEqual(handler.profile.async_http, 0.1)
+
+        (recorded_handler, message, latency), kwargs = record.call_args
+        self.assertIs(recorded_handler, handler)
+        self.assertGreaterEqual(latency, 0.1)
+
+    def test_asgi_middleware_is_async(self):
+        """ sync middleware would take a thread for every request of async webhook,
+        WhiteNoise is removed from middleware under asgi """
+        for path in settings.MIDDLEWARE:
+            if path != 'whitenoise.middleware.WhiteNoiseMiddleware':
+                self.assertTrue(getattr(import_string(path), 'async_capable', False), path)
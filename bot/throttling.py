@@ -0,0 +1,131 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from . import analytics
+
+
+logger = logging.getLogger('dag_afisha_logger')
+
+
+class LocalTokenBuckets:
+    """ Token buckets of users kept in memory of the process.
+    Map is bounded, least recently active users are evicted first """
+
+    def __init__(self, rate, burst, maxsize):
+        """
+        :param rate: tokens added to bucket per second
+        :param burst: capacity of bucket
+        :param maxsize: max count of tracked users
+        """
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key):
+        """ :return True if user has a token for the update """
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+
+        return allowed
+
+
+class RedisTokenBuckets:
+    """ Token buckets shared by all workers, requires redis package """
+
+    script = """
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+
+        return allowed
+    """
+
+    def __init__(self, url, rate, burst):
+        import redis
+
+        self.rate = rate
+        self.burst = burst
+        # full bucket doesn't differ from missing one, so it can expire
+        self.ttl = math.ceil(burst / rate) + 1
+        self.client = redis.StrictRedis.from_url(url)
+        self.consume_script = self.client.register_script(self.script)
+
+    def consume(self, key):
+        try:
+            allowed = self.consume_script(
+                keys=['flood_control:{}'.format(key)],
+                args=[self.rate, self.burst, time.time(), self.ttl],
+            )
+        except Exception:
+            # bot must keep working without redis
+            logger.exception('flood control redis failed')
+            return True
+
+        return bool(allowed)
+
+
+def get_buckets():
+    if settings.FLOOD_CONTROL_REDIS_URL:
+        try:
+            return RedisTokenBuckets(
+                settings.FLOOD_CONTROL_REDIS_URL,
+                rate=settings.FLOOD_CONTROL_RATE,
+                burst=settings.FLOOD_CONTROL_BURST,
+            )
+        except ImportError:
+            logger.exception('redis package is not installed, flood control uses memory of the process')
+
+    return LocalTokenBuckets(
+        rate=settings.FLOOD_CONTROL_RATE,
+        burst=settings.FLOOD_CONTROL_BURST,
+        maxsize=settings.FLOOD_CONTROL_MAX_USERS,
+    )
+
+
+buckets = get_buckets()
+
+
+def throttled(handle):
+    """ wrap message handler for dropping updates of users sending too often """
+
+    def throttled_handle(message, **kwargs):
+        if not buckets.consume(message.from_user.id):
+            # counters of throttled updates are kept in analytics rollups
+            analytics.record_event(analytics.THROTTLED, message, 0)
+            return None
+
+        return handle(message, **kwargs)
+
+    throttled_handle.handler_class = handle.handler_class
+
+    return throttled_handle
@@ -0,0 +1,94 @@
+import threading
+from django.conf import settings
+from django.db import transaction
+from . import models as bot_md
+from .buffers import BatchBuffer
+
+
+def save_users(users):
+    """ upsert users by account id, the last data of user wins """
+    users = {user['account_id']: user for user in users}
+
+    with transaction.atomic():
+        existing = dict(bot_md.TelegramUser.objects.filter(
+            account_id__in=users.keys()
+        ).values_list('account_id', 'chat_id'))
+
+        for account_id, chat_id in existing.items():
+            user = users.pop(account_id)
+            if chat_id != user['chat_id']:
+                bot_md.TelegramUser.objects.filter(account_id=account_id).update(chat_id=user['chat_id'])
+
+        bot_md.TelegramUser.objects.bulk_create(
+            bot_md.TelegramUser(**user) for user in users.values()
+        )
+
+
+class KnownUsers:
+    """ Account ids with chat ids of bot users cached in memory of the process.
+    Cache is loaded from db on the first use, new users
+    and changed chats are saved in batches """
+
+    def __init__(self):
+        self.chats = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.pending = BatchBuffer(
+            self.save,
+            maxlen=settings.KNOWN_USERS_BUFFER_SIZE,
+            batch_size=settings.KNOWN_USERS_BATCH_SIZE,
+            interval=settings.KNOWN_USERS_FLUSH_INTERVAL,
+        )
+
+    def load(self):
+        if self._loaded:
+            return None
+
+        with self._lock:
+            if not self._loaded:
+                self.chats.update(bot_md.TelegramUser.objects.values_list('account_id', 'chat_id'))
+                self._loaded = True
+
+    def forget(self, users):
+        """ forget unsaved users, so they are queued again on the next /start """
+        for user in users:
+            if self.chats.get(user['account_id']) == user['chat_id']:
+                self.chats.pop(user['account_id'], None)
+
+    def save(self, users):
+        try:
+            save_users(users)
+        except Exception:
+            self.forget(users)
+            raise
+
+    def remember(self, message):
+        """ queue saving of user if it's new or its chat was changed,
+        chat_id need for sending messages for users
+        :return True if user was queued
+        """
+        self.load()
+
+        account_id = message.from_user.id
+        chat_id = message.chat.id
+
+        if self.chats.get(account_id) == chat_id:
+            return False
+
+        self.chats[account_id] = chat_id
+        dropped_user = self.pending.add({
+            'account_id': account_id,
+            'chat_id': chat_id,
+            'is_bot': message.from_user.is_bot,
+            'first_name': message.from_user.first_name,
+            'last_name': message.from_user.last_name,
+            'username': message.from_user.username,
+        })
+        # full buffer drops the oldest user, it isn't saved
+        if dropped_user is not None:
+            self.forget([dropped_user])
+
+        return True
+
+
+known_users = KnownUsers()
@@ -1,5 +1,8 @@
 import os
+import time
+import threading
 from django.conf import settings
+from django.db import connection
 from itertools import groupby
 from django.utils import timezone
 import telebot
@@ -7,6 +10,10 @@ import requests
 import logging
 from bs4 import BeautifulSoup
 from . import models as bot_md
+from .analytics import tracked
+from .throttling import throttled
+from .profiling import profiled
+from .users import known_users
 
 
 dag_afisha_bot = telebot.TeleBot(settings.DAG_AFISHA_TOKEN, threaded=False)
@@ -23,12 +30,71 @@ EMOJI = {
     'back': b'\xF0\x9F\x94\x99'.decode('utf-8')
 }
 
+# cinema sites return schedule table only for ajax requests
+AJAX_HEADER = {
+    'X-Requested-With': 'XMLHttpRequest'
+}
+
+
+class ScheduleSourceUnavailable(Exception):
+    """ cinema site is down or its circuit breaker is open """
+
+
+def fetch_schedule_html(cinema, selected_day, health=None):
+    """ get schedule from remote site and record health of the source """
+
+    day_str = selected_day.strftime('%Y-%m-%d')
+
+    if health is None:
+        health = bot_md.CinemaHealth.get_for(cinema)
+    start = time.monotonic()
+
+    try:
+        response = requests.post(
+            cinema.schedule_url,
+            data={'day': day_str},
+            headers=AJAX_HEADER,
+            timeout=settings.SCHEDULE_REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        health.record_failure(time.monotonic() - start, e)
+        dag_afisha_logger.info('schedule source of {} failed: {}'.format(cinema, e))
+        raise ScheduleSourceUnavailable(str(e)) from e
+
+    health.record_success(time.monotonic() - start)
+
+    schedule_html = response.content.decode('utf-8')
+
+    return schedule_html.strip()
+
+
+def probe_schedule_source(cinema):
+    """ check unavailable source in background thread,
+    successful request closes circuit breaker """
+
+    def probe():
+        try:
+            fetch_schedule_html(cinema, timezone.now())
+        except ScheduleSourceUnavailable:
+            pass
+        finally:
+            connection.close()
+
+    threading.Thread(target=probe, daemon=True).start()
+
 
 class BaseMessageHandler:
     keyboard_row_width = 0
 
-    def __init__(self, message):
+    def __init__(self, message, defer_io=False):
+        """
+        :param defer_io: don't make outbound requests, responses are collected
+            in outbox and sent by the caller, it's used by async webhook
+        """
         self.message = message
+        self.defer_io = defer_io
+        self.outbox = []
         self.dispatch()
 
     def dispatch(self):
@@ -38,24 +104,8 @@ class BaseMessageHandler:
         if self.message.text != '/start':
             return self.send_response()
 
-        chat_id = self.message.chat.id
-
-        bot_user, created = bot_md.TelegramUser.objects.get_or_create(
-            account_id=self.message.from_user.id,
-            defaults={
-                'chat_id': chat_id,
-                'is_bot': self.message.from_user.is_bot,
-                'first_name': self.message.from_user.first_name,
-                'last_name': self.message.from_user.last_name,
-                'username': self.message.from_user.username,
-            }
-        )
-
-        # if chat_id was changed then set new chat_id,
-        # chat_id need for sending messages for users
-        if bot_user.chat_id != chat_id:
-            bot_user.chat_id = chat_id
-            bot_user.save()
+        # known users cost no queries, new ones are saved in background
+        known_users.remember(self.message)
 
         self.send_response()
 
@@ -63,6 +113,22 @@ class BaseMessageHandler:
         """ sending response from bot """
         raise NotImplementedError
 
+    def reply(self, text, **kwargs):
+        """ send message to the chat of handled message """
+        if self.defer_io:
+            self.outbox.append((self.message.chat.id, text, kwargs))
+            return None
+
+        dag_afisha_bot.send_message(self.message.chat.id, text, **kwargs)
+
+    def get_event_data(self):
+        """ data of handled update for analytics """
+        return {
+            'cinema': '',
+            'day_offset': None,
+            'cache_hit': None,
+        }
+
     def get_markup(self, chunk_btn_texts):
         markup = telebot.types.ReplyKeyboardMarkup(row_width=self.keyboard_row_width, resize_keyboard=True)
         for btn_texts in chunk_btn_texts:
@@ -76,8 +142,10 @@ class Cinemas(BaseMessageHandler):
     keyboard_row_width = 3
     response_msg = 'Выберите кинотеатр'
 
-    def __init__(self, message):
+    def __init__(self, message, defer_io=False):
         self.message = message
+        self.defer_io = defer_io
+        self.outbox = []
         self.selected_cinema = self.get_selected_cinema()
         self.dispatch()
 
@@ -94,15 +162,18 @@ class Cinemas(BaseMessageHandler):
 
         return bot_md.Cinema.objects.get(title=selected_cinema.value)
 
+    def get_event_data(self):
+        event_data = super(Cinemas, self).get_event_data()
+        if self.selected_cinema:
+            event_data['cinema'] = self.selected_cinema.title
+
+        return event_data
+
     def send_response(self):
         chunk_cinemas = self.get_chunk_cinemas()
         markup = self.get_markup(chunk_cinemas)
 
-        dag_afisha_bot.send_message(
-            self.message.chat.id,
-            self.response_msg,
-            reply_markup=markup
-        )
+        self.reply(self.response_msg, reply_markup=markup)
 
     def get_chunk_cinemas(self):
         """ chunk cinemas form table display in telegram keyboard
@@ -127,10 +198,7 @@ class Info(Cinemas):
         return self.send_response()
 
     def send_response(self):
-        dag_afisha_bot.send_message(
-            self.message.chat.id,
-            self.selected_cinema.description,
-        )
+        self.reply(self.selected_cinema.description)
 
 
 class Week(BaseMessageHandler):
@@ -153,6 +221,12 @@ class Week(BaseMessageHandler):
 
         super(Week, self).dispatch()
 
+    def get_event_data(self):
+        event_data = super(Week, self).get_event_data()
+        event_data['cinema'] = self.message.text
+
+        return event_data
+
     @classmethod
     def get_week_days(cls):
         """ getter for __week_days attribute """
@@ -180,15 +254,16 @@ class Week(BaseMessageHandler):
         chunks_week_range = self.get_chunks_week_range()
         markup = self.get_markup(chunks_week_range)
 
-        dag_afisha_bot.send_message(
-            self.message.chat.id,
-            self.response_msg,
-            reply_markup=markup
-        )
+        self.reply(self.response_msg, reply_markup=markup)
 
 
 class FilmSchedule(Cinemas):
     model = bot_md.FilmSchedule
+    # was schedule found in db, for analytics
+    cache_hit = None
+    # day whose schedule has to be fetched by the caller when defer_io is set
+    pending_day = None
+    source_health = None
 
     def dispatch(self):
         # if selected cinema doesn't exist then send cinemas for selecting
@@ -199,33 +274,61 @@ class FilmSchedule(Cinemas):
 
     def send_response(self):
         schedule = self.get_schedule()
-        if not schedule.exists():
-            schedule = self.parse_schedule_html()
+        self.cache_hit = schedule.exists()
+        if self.cache_hit:
+            return self.send_schedule(schedule)
+
+        try:
+            self.source_health = self.check_schedule_source()
+        except ScheduleSourceUnavailable:
+            return self.send_unavailable()
+
+        # async webhook fetches html itself and then calls send_parsed_schedule
+        if self.defer_io:
+            self.pending_day = self.selected_day
+            return None
+
+        try:
+            schedule_html = fetch_schedule_html(self.selected_cinema, self.selected_day, self.source_health)
+        except ScheduleSourceUnavailable:
+            return self.send_unavailable()
+
+        self.send_parsed_schedule(schedule_html)
 
+    def send_parsed_schedule(self, schedule_html):
+        schedule = self.parse_schedule_html(schedule_html)
+        self.send_schedule(schedule)
+
+    def send_schedule(self, schedule):
         if not schedule:
-            dag_afisha_bot.send_message(
-                self.message.chat.id,
-                'Расписания пока нет'
-            )
+            self.reply('Расписания пока нет')
             return None
 
         pretty_films_schedule = self.get_pretty_schedule(schedule)
 
-        dag_afisha_bot.send_message(
-            self.message.chat.id,
-            pretty_films_schedule,
-            parse_mode='HTML'
-        )
+        self.reply(pretty_films_schedule, parse_mode='HTML')
+
+    def send_unavailable(self):
+        self.reply('Расписание временно недоступно, попробуйте позже')
 
     @property
-    def selected_day(self):
-        week_days = Week.get_week_days()
+    def day_offset(self):
+        """ count of days from today to selected day """
+        return Week.get_week_days().index(self.message.text)
 
-        offset = week_days.index(self.message.text)
-        selected_day = timezone.now() + timezone.timedelta(days=offset)
+    @property
+    def selected_day(self):
+        selected_day = timezone.now() + timezone.timedelta(days=self.day_offset)
 
         return selected_day
 
+    def get_event_data(self):
+        event_data = super(FilmSchedule, self).get_event_data()
+        event_data['day_offset'] = self.day_offset
+        event_data['cache_hit'] = self.cache_hit
+
+        return event_data
+
     def get_schedule(self):
         """ get schedule from db """
         selected_day = self.selected_day
@@ -236,29 +339,23 @@ class FilmSchedule(Cinemas):
         )
         return schedule
 
-    def get_schedule_html(self, selected_day):
-        """ get schedule from remote site """
-
-        day_str = selected_day.strftime('%Y-%m-%d')
-
-        ajax_header = {
-            'X-Requested-With': 'XMLHttpRequest'
-        }
+    def check_schedule_source(self):
+        """ fail fast if the remote site is unavailable
+        :return health of the source
+        :raise ScheduleSourceUnavailable
+        """
+        health = bot_md.CinemaHealth.get_for(self.selected_cinema)
 
-        response = requests.post(
-            self.selected_cinema.schedule_url,
-            data={'day': day_str},
-            headers=ajax_header
-        )
-        schedule_html = response.content.decode('utf-8')
+        if not health.is_available():
+            if health.claim_probe():
+                probe_schedule_source(self.selected_cinema)
+            raise ScheduleSourceUnavailable(health.last_error)
 
-        return schedule_html.strip()
+        return health
 
-    def parse_schedule_html(self):
+    def parse_schedule_html(self, schedule_html):
         """ parse schedule html and save in db """
 
-        schedule_html = self.get_schedule_html(self.selected_day)
-
         if not schedule_html.startswith('<table'):
             return None
 
@@ -266,6 +363,7 @@ class FilmSchedule(Cinemas):
 
         films = table.find_all('tr')
 
+        schedule = []
         for film in films:
             name, info = film.find_all('td')
             name = name.find('a').string
@@ -277,14 +375,19 @@ class FilmSchedule(Cinemas):
                 price = info.find_all('b')[-1].string
                 price = price.split()[0].strip()
 
-                self.model.objects.create(
+                schedule.append(self.model(
                     cinema=self.selected_cinema,
                     name=name,
                     time=time,
                     film_format=film_format,
                     price=int(price),
                     date=self.selected_day
-                )
+                ))
+
+        # bulk_create doesn't send post_save, so api snapshot is invalidated here
+        # and rebuilt lazily on the next api request
+        self.model.objects.bulk_create(schedule)
+        bot_md.ScheduleSnapshot.objects.filter(cinema=self.selected_cinema).delete()
 
         schedule = self.model.objects.filter(cinema=self.selected_cinema, date=self.selected_day)
 
@@ -318,11 +421,11 @@ class FilmSchedule(Cinemas):
 cinemas = bot_md.Cinema.objects.values_list('title', flat=True)
 
 # mark all classes for handling messages
-dag_afisha_bot.message_handler(commands=['start'])(Cinemas)
-dag_afisha_bot.message_handler(regexp=EMOJI['back'])(Cinemas)
+dag_afisha_bot.message_handler(commands=['start'])(throttled(profiled(tracked(Cinemas))))
+dag_afisha_bot.message_handler(regexp=EMOJI['back'])(throttled(profiled(tracked(Cinemas))))
 
-dag_afisha_bot.message_handler(regexp='Инфо')(Info)
+dag_afisha_bot.message_handler(regexp='Инфо')(throttled(profiled(tracked(Info))))
 
-dag_afisha_bot.message_handler(func=lambda message: message.text in cinemas)(Week)
+dag_afisha_bot.message_handler(func=lambda message: message.text in cinemas)(throttled(profiled(tracked(Week))))
 
-dag_afisha_bot.message_handler(func=lambda message: message.text in Week.get_week_days())(FilmSchedule)
+dag_afisha_bot.message_handler(func=lambda message: message.text in Week.get_week_days())(throttled(profiled(tracked(FilmSchedule))))
@@ -0,0 +1,23 @@
+"""
+ASGI config for dag_afisha project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Telegram updates are handled by async webhook here, run it with:
+
+    gunicorn dag_afisha.asgi -k uvicorn.workers.UvicornWorker
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dag_afisha.settings')
+os.environ.setdefault('DAG_AFISHA_ASYNC_WEBHOOK', '1')
+
+# WhiteNoise middleware is disabled under asgi, static files are only
+# needed by admin, so they are served by django staticfiles handler
+application = ASGIStaticFilesHandler(get_asgi_application())
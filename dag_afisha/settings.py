@@ -76,6 +76,17 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'dag_afisha.wsgi.application'
 
+# Async webhook is enabled by asgi entry point
+ASYNC_WEBHOOK = bool(os.environ.get('DAG_AFISHA_ASYNC_WEBHOOK'))
+
+# WhiteNoise is sync only and would take a thread for every request under asgi,
+# static files are served by asgi entry point itself
+if ASYNC_WEBHOOK:
+    MIDDLEWARE.remove('whitenoise.middleware.WhiteNoiseMiddleware')
+
+# size of thread pool for ORM and handlers in async webhook
+ASYNC_ORM_THREADS = int(os.environ.get('ASYNC_ORM_THREADS', 10))
+
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
@@ -130,6 +141,68 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 DEFAULT_FROM_EMAIL = 'dag-afisha@yandex.ru'
 
+# Cinema schedule sources
+# timeout of request to cinema site in seconds: (connect, read)
+SCHEDULE_REQUEST_TIMEOUT = (3, 10)
+
+# failed requests in a row after which source is considered unavailable
+SCHEDULE_BREAKER_THRESHOLD = 3
+
+# seconds before unavailable source is probed again
+SCHEDULE_BREAKER_COOLDOWN = 60
+
+# Analytics of handled updates
+# sink for batches of events: 'db', 'file' or 'chatbase'
+ANALYTICS_SINK = 'db'
+
+ANALYTICS_FILE = os.path.join(BASE_DIR, 'bot', 'analytics.log')
+
+# max count of events kept in memory, the oldest are dropped on overflow
+ANALYTICS_BUFFER_SIZE = 10000
+
+ANALYTICS_BATCH_SIZE = 500
+
+# seconds between flushes of events
+ANALYTICS_FLUSH_INTERVAL = 30
+
+# Flood control of users by token buckets
+# tokens per second added to user's bucket
+FLOOD_CONTROL_RATE = 1
+
+# max count of updates user can send at once
+FLOOD_CONTROL_BURST = 5
+
+# max count of users tracked in memory of the process
+FLOOD_CONTROL_MAX_USERS = 10000
+
+# buckets are shared by workers through redis if url is set, requires redis package
+FLOOD_CONTROL_REDIS_URL = os.environ.get('FLOOD_CONTROL_REDIS_URL', '')
+
+# Profiling of updates, dumps are summarised by profile_summary command
+# fraction of randomly profiled updates
+PROFILE_UPDATES_RATE = float(os.environ.get('PROFILE_UPDATES_RATE', 0))
+
+# handler class names and chat ids whose updates are always profiled, comma separated
+PROFILE_UPDATES_HANDLERS = [
+    name for name in os.environ.get('PROFILE_UPDATES_HANDLERS', '').split(',') if name
+]
+PROFILE_UPDATES_CHATS = [
+    int(chat_id) for chat_id in os.environ.get('PROFILE_UPDATES_CHATS', '').split(',') if chat_id
+]
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# only the newest dumps are kept
+PROFILE_MAX_DUMPS = 200
+
+# Known users cached in memory, new users are saved in batches
+KNOWN_USERS_BUFFER_SIZE = 10000
+
+KNOWN_USERS_BATCH_SIZE = 100
+
+# seconds between saves of new users
+KNOWN_USERS_FLUSH_INTERVAL = 10
+
 import dj_database_url
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
@@ -18,7 +18,13 @@ from django.urls import path
 from django.conf import settings
 from main import views as vs
 
+if settings.ASYNC_WEBHOOK:
+    webhook_view = vs.async_webhook
+else:
+    webhook_view = vs.DagAfishaWebhookHandler.as_view()
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path(f'webhook/{settings.DAG_AFISHA_TOKEN}/', vs.DagAfishaWebhookHandler.as_view()),
+    path(f'webhook/{settings.DAG_AFISHA_TOKEN}/', webhook_view),
+    path('api/cinemas/<int:cinema_id>/schedule/', vs.CinemaScheduleApi.as_view()),
 ]
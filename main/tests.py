@@ -1,3 +1,79 @@
-from django.test import TestCase
+import gzip
+import json
+from django.test import TestCase, RequestFactory
+from django.utils import timezone
+from bot import models as bot_md
+from . import views as vs
 
-# Create your tests here.
+
+class CinemaScheduleApiTest(TestCase):
+
+    def setUp(self):
+        self.cinema = bot_md.Cinema.objects.create(title='Москва')
+        bot_md.FilmSchedule.objects.create(
+            cinema=self.cinema,
+            name='Фильм',
+            time='12:00',
+            price=250,
+            film_format='2D',
+            date=timezone.localdate(),
+        )
+        self.url = '/api/cinemas/{}/schedule/'.format(self.cinema.pk)
+
+    def test_plain_json(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['cinema']['title'], 'Москва')
+        self.assertEqual(data['days'][0]['films'][0]['sessions'][0]['price'], 250)
+
+    def test_gzip_json(self):
+        plain = self.client.get(self.url)
+        gzipped = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.content), plain.content)
+        self.assertNotEqual(gzipped['ETag'], plain['ETag'])
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # etag of plain json doesn't match gzipped representation
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+
+    def test_changed_schedule_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+
+        bot_md.FilmSchedule.objects.update(price=300)
+        bot_md.FilmSchedule.objects.first().save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_unknown_cinema(self):
+        response = self.client.get('/api/cinemas/{}/schedule/'.format(self.cinema.pk + 1))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_accepts_gzip(self):
+        factory = RequestFactory()
+        cases = (
+            ('gzip', True),
+            ('deflate, gzip;q=0.5', True),
+            ('gzip;q=0', False),
+            ('*', True),
+            ('*;q=0.5, gzip;q=0', False),
+            ('identity', False),
+            ('', False),
+        )
+        for header, expected in cases:
+            request = factory.get('/', HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(vs.accepts_gzip(request), expected, header)
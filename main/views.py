@@ -5,8 +5,31 @@ import telebot
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views import generic as gc
+from django.utils.cache import parse_etags
 from django import http
 from bot.views import dag_afisha_bot, dag_afisha_logger
+from bot import models as bot_md
+
+
+def accepts_gzip(request):
+    """ check gzip coding in Accept-Encoding header including its q-value """
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+
+        quality = 1
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+
+        qualities[name.lower()] = quality
+
+    # explicit gzip coding takes precedence over wildcard
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -39,3 +62,60 @@ class DagAfishaWebhookHandler(gc.View):
 
         return http.HttpResponse()
 
+
+async def async_webhook(request):
+    """ handle sent updates from telegram without blocking on outbound io,
+    it's used instead of DagAfishaWebhookHandler when served by asgi """
+    # aiohttp is required only for asgi deployment
+    from bot import aio
+
+    if request.method == 'GET':
+        return await aio.run_sync(DagAfishaWebhookHandler.as_view(), request)
+
+    if request.method != 'POST':
+        return http.HttpResponseNotAllowed(['GET', 'POST'])
+
+    json_update = request.body.decode('utf-8')
+    dag_afisha_logger.info('==========================================')
+    dag_afisha_logger.info('dag_fisha: '+json_update)
+
+    update = telebot.types.Update.de_json(json_update)
+
+    await aio.process_message(update.message)
+
+    return http.HttpResponse()
+
+
+# csrf_exempt decorator wraps view in sync function, so async view is marked directly
+async_webhook.csrf_exempt = True
+
+
+class CinemaScheduleApi(gc.View):
+    """ read-only weekly schedule of cinema in json,
+    served from precomputed snapshot with etag support """
+
+    def get(self, request, cinema_id):
+        try:
+            snapshot = bot_md.ScheduleSnapshot.get_actual(cinema_id)
+        except bot_md.Cinema.DoesNotExist:
+            raise http.Http404('Cinema does not exist')
+
+        gzipped = accepts_gzip(request)
+        etag = snapshot.get_etag(gzipped)
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+
+        if etag in if_none_match or '*' in if_none_match:
+            response = http.HttpResponseNotModified()
+        else:
+            response = http.HttpResponse(
+                snapshot.get_content(gzipped),
+                content_type='application/json; charset=utf-8'
+            )
+            if gzipped:
+                response['Content-Encoding'] = 'gzip'
+
+        response['ETag'] = etag
+        response['Vary'] = 'Accept-Encoding'
+        response['Cache-Control'] = 'no-cache'
+
+        return response